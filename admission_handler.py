@@ -0,0 +1,115 @@
+import re
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from starlette.responses import JSONResponse
+import config
+
+# Every request is put in a route class before it reaches the threadpool, excess work is rejected right away
+# with 503 and Retry-After instead of queueing for a database connection until it times out.
+ROUTE_CLASSES = [
+    (re.compile(r"^/token/?$"), None, "auth"),
+    (re.compile(r"^/users(/|$)"), None, "admin"),
+    (re.compile(r"^/groups/search/?$"), None, "search"),
+    (re.compile(r"^/groups/[^/]+/messages(/|$)"), None, "messages"),
+    (re.compile(r"^/groups(/|$)"), "GET", "reads"),
+    (re.compile(r"^/groups(/|$)"), None, "writes"),
+]
+
+_lock = threading.Lock()
+_pool_wait = {"value": 0.0, "updated": time.monotonic()}
+metrics = {route_class: {"in_flight": 0, "admitted": 0, "shed_in_flight": 0, "shed_pool_wait": 0,
+                         "pool_waits": 0, "pool_timeouts": 0, "pool_wait_total": 0.0, "pool_wait_max": 0.0}
+           for route_class in config.ADMISSION_LIMITS}
+
+
+def get_route_class(method: str, path: str):
+    for pattern, route_method, route_class in ROUTE_CLASSES:
+        if pattern.match(path) and route_method in (None, method):
+            return route_class
+    return None
+
+
+def recent_pool_wait() -> float:
+    # moving average of pool waits, decayed by the time since the last sample
+    with _lock:
+        age = time.monotonic() - _pool_wait["updated"]
+        return _pool_wait["value"] * 0.5 ** (age / config.ADMISSION_POOL_WAIT_HALF_LIFE_SECONDS)
+
+
+def record_pool_wait(route_class, wait: float, timed_out: bool = False) -> None:
+    decayed = recent_pool_wait()
+    with _lock:
+        _pool_wait["value"] = 0.8 * decayed + 0.2 * wait
+        _pool_wait["updated"] = time.monotonic()
+        if route_class in metrics:
+            route_metrics = metrics[route_class]
+            route_metrics["pool_waits"] += 1
+            route_metrics["pool_wait_total"] += wait
+            route_metrics["pool_wait_max"] = max(route_metrics["pool_wait_max"], wait)
+            route_metrics["pool_timeouts"] += timed_out
+
+
+@contextmanager
+def measure_pool_wait(route_class):
+    # a wait that ends in a pool timeout is the longest of all, it has to count too
+    start = time.perf_counter()
+    timed_out = False
+    try:
+        yield
+    except PoolTimeoutError:
+        timed_out = True
+        raise
+    finally:
+        record_pool_wait(route_class, time.perf_counter() - start, timed_out)
+
+
+def admit(route_class):
+    # Returns None when the request may run, otherwise the metric counting why it was shed
+    limits = config.ADMISSION_LIMITS[route_class]
+    route_metrics = metrics[route_class]
+    in_flight = sum(class_metrics["in_flight"] for class_metrics in metrics.values())
+    if route_metrics["in_flight"] >= limits["max_in_flight"] or in_flight >= limits["max_total_in_flight"]:
+        reason = "shed_in_flight"
+    elif recent_pool_wait() > limits["max_pool_wait"]:
+        reason = "shed_pool_wait"
+    else:
+        route_metrics["in_flight"] += 1
+        route_metrics["admitted"] += 1
+        return None
+    route_metrics[reason] += 1
+    return reason
+
+
+def get_metrics() -> dict:
+    with _lock:
+        snapshot = {route_class: dict(route_metrics) for route_class, route_metrics in metrics.items()}
+    for route_metrics in snapshot.values():
+        waits = route_metrics.pop("pool_waits")
+        wait_total = route_metrics.pop("pool_wait_total")
+        route_metrics["pool_wait_avg"] = wait_total / waits if waits else 0.0
+    return {"pool_wait_recent": recent_pool_wait(), "routes": snapshot}
+
+
+class AdmissionMiddleware:
+    # Plain ASGI middleware, so a request counts as in flight until its whole response, streamed or not, is sent.
+    # It runs on the event loop, which is why the in flight counters need no lock.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        route_class = get_route_class(scope["method"], scope["path"]) if scope["type"] == "http" else None
+        if route_class is None:
+            await self.app(scope, receive, send)
+            return
+        if admit(route_class):
+            response = JSONResponse({"detail": "Server is busy, try again later"}, status_code=503,
+                                    headers={"Retry-After": str(config.ADMISSION_RETRY_AFTER_SECONDS)})
+            await response(scope, receive, send)
+            return
+        scope.setdefault("state", {})["route_class"] = route_class
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            metrics[route_class]["in_flight"] -= 1
@@ -0,0 +1,130 @@
+import bisect
+import json
+import mmap
+import os
+import struct
+import uuid
+import zlib
+from datetime import datetime
+from functools import lru_cache
+import config
+import model
+
+# A segment file holds archived messages of one group in increasing id order:
+#   MAGIC, zlib compressed blocks of up to BLOCK_SIZE JSON lines, zlib compressed JSON index, footer.
+# The index is sparse, one [first_id, last_id, offset, length] entry per block, and the footer gives the offset
+# and length of the index. Segments are never changed after they are written, so readers mmap them and only
+# decompress the blocks they need.
+MAGIC = b"CKSEG1\n"
+FOOTER = struct.Struct("<QQ")
+BLOCK_SIZE = 256
+
+
+def group_archive_dir(group_id: int) -> str:
+    return os.path.join(config.MESSAGE_ARCHIVE_DIR, f"group_{group_id}")
+
+
+def segment_paths(group_id: int):
+    directory = group_archive_dir(group_id)
+    if not os.path.isdir(directory):
+        return []
+    # names start with the zero padded first id, so name order is id order
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith(".seg")]
+
+
+def message_to_record(message, likes) -> dict:
+    return {"id": message.id, "group_id": message.group_id, "user_id": message.user_id,
+            "message": message.message,
+            "created_at": message.created_at.isoformat() if message.created_at else None,
+            "likes": [{"id": like.id, "user_id": like.user_id} for like in likes]}
+
+
+def record_to_message(record) -> model.Message:
+    created_at = datetime.fromisoformat(record["created_at"]) if record["created_at"] else None
+    return model.Message(id=record["id"], group_id=record["group_id"], user_id=record["user_id"],
+                         message=record["message"], created_at=created_at)
+
+
+def write_segment(group_id: int, records) -> int:
+    # records must be in increasing id order and above last_archived_id(group_id)
+    directory = group_archive_dir(group_id)
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, "segment.tmp")
+    index = []
+    block = []
+    count = 0
+    with open(tmp_path, "wb") as segment:
+        segment.write(MAGIC)
+
+        def write_block():
+            data = zlib.compress("".join(json.dumps(record) + "\n" for record in block).encode())
+            index.append([block[0]["id"], block[-1]["id"], segment.tell(), len(data)])
+            segment.write(data)
+            block.clear()
+
+        for record in records:
+            block.append(record)
+            count += 1
+            if len(block) >= BLOCK_SIZE:
+                write_block()
+        if block:
+            write_block()
+        index_offset = segment.tell()
+        index_data = zlib.compress(json.dumps(index).encode())
+        segment.write(index_data)
+        segment.write(FOOTER.pack(index_offset, len(index_data)))
+        segment.flush()
+        os.fsync(segment.fileno())
+    if not index:
+        os.remove(tmp_path)
+        return 0
+    # a segment removed after a mismatch is written again with the same first id, the random part keeps the
+    # name new so processes that cached the index of the removed one never read the new file with it
+    os.replace(tmp_path, os.path.join(directory, f"{index[0][0]:020d}-{index[-1][1]:020d}-{uuid.uuid4().hex}.seg"))
+    return count
+
+
+def remove_segment(path: str) -> None:
+    os.remove(path)
+    read_index.cache_clear()
+
+
+@lru_cache(maxsize=1024)
+def read_index(path: str):
+    with open(path, "rb") as segment, mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a message segment")
+        index_offset, index_length = FOOTER.unpack(data[-FOOTER.size:])
+        return json.loads(zlib.decompress(data[index_offset:index_offset + index_length]))
+
+
+def read_block(path: str, entry):
+    first_id, last_id, offset, length = entry
+    with open(path, "rb") as segment, mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return [json.loads(line) for line in zlib.decompress(data[offset:offset + length]).splitlines()]
+
+
+def last_archived_id(group_id: int, paths=None) -> int:
+    paths = segment_paths(group_id) if paths is None else paths
+    return read_index(paths[-1])[-1][1] if paths else 0
+
+
+def iter_records(group_id: int, paths=None):
+    for path in segment_paths(group_id) if paths is None else paths:
+        for entry in read_index(path):
+            yield from read_block(path, entry)
+
+
+def read_messages(group_id: int, before_id: int = None, limit: int = 50):
+    # Newest first, like the hot history query. Only blocks holding ids below before_id are decompressed.
+    messages = []
+    for path in reversed(segment_paths(group_id)):
+        index = read_index(path)
+        end = len(index) if before_id is None else bisect.bisect_left([entry[0] for entry in index], before_id)
+        for entry in reversed(index[:end]):
+            for record in reversed(read_block(path, entry)):
+                if before_id is None or record["id"] < before_id:
+                    messages.append(record_to_message(record))
+                    if len(messages) >= limit:
+                        return messages
+    return messages
@@ -0,0 +1,127 @@
+# Moves messages older than config.MESSAGE_ARCHIVE_AFTER_DAYS, with their likes, out of the shard databases into
+# compressed segment files under config.MESSAGE_ARCHIVE_DIR. History pagination and export read them back from there.
+#
+# Usage:
+#   python archive_messages.py [--days 90]
+#
+# It can run while the application is serving requests. Only a prefix of each group's history by id is archived,
+# so every archived id stays below every hot id of the group. A segment is written and synced first, then all its
+# rows are deleted in one transaction, but only rows that still match the segment, likes included. If a row
+# changed in between, for example a like was posted, nothing is deleted, the segment is removed again and the
+# group is archived on the next run. Refuses to run on databases that may hand out message ids again, run
+# migrate_messages.py first.
+import argparse
+from datetime import datetime, timedelta
+from sqlalchemy import select, delete, func
+import archive_handler
+import config
+import model
+from db_handler import shard_engines
+from migrate_messages import ids_can_be_reused
+
+BATCH_SIZE = archive_handler.BLOCK_SIZE
+
+
+class SegmentMismatch(Exception):
+    pass
+
+
+def finish_segment(engine, group_id: int, path: str) -> bool:
+    # Deletes the hot rows stored in the segment. Returns False, after removing the segment, when they no longer
+    # match it, the hot rows stay the only copy then.
+    messages = model.Message.__table__
+    likes = model.MessageLike.__table__
+    index = archive_handler.read_index(path)
+    try:
+        with engine.begin() as conn:
+            for entry in index:
+                records = archive_handler.read_block(path, entry)
+                hot = {row.id: row for row in conn.execute(
+                    select(messages).where(messages.c.group_id == group_id,
+                                           messages.c.id.in_([record["id"] for record in records]))
+                    .with_for_update())}
+                if entry is index[0] and not hot:
+                    # rows of a segment are deleted all at once, so this one was finished before
+                    return True
+                hot_likes = {}
+                for like in conn.execute(select(likes).where(likes.c.message_id.in_(list(hot)))):
+                    hot_likes.setdefault(like.message_id, set()).add((like.id, like.user_id))
+                for record in records:
+                    row = hot.get(record["id"])
+                    if row is None:
+                        raise RuntimeError(f"Message {record['id']} of {path} is neither archived nor hot")
+                    archived_likes = {(like["id"], like["user_id"]) for like in record["likes"]}
+                    if (row.user_id, row.message) != (record["user_id"], record["message"]) \
+                            or hot_likes.get(row.id, set()) != archived_likes:
+                        raise SegmentMismatch(record["id"])
+                like_ids = [like_id for message_likes in hot_likes.values() for like_id, user_id in message_likes]
+                conn.execute(delete(likes).where(likes.c.id.in_(like_ids)))
+                # a like posted after the read above would be lost with its message, check again now the
+                # delete holds the write lock
+                if conn.execute(select(likes.c.id).where(likes.c.message_id.in_(list(hot)))
+                                .with_for_update()).first():
+                    raise SegmentMismatch(records[0]["id"])
+                conn.execute(delete(messages).where(messages.c.group_id == group_id, messages.c.id.in_(list(hot))))
+    except SegmentMismatch:
+        archive_handler.remove_segment(path)
+        return False
+    return True
+
+
+def archive_group(engine, group_id: int, cutoff: datetime) -> int:
+    messages = model.Message.__table__
+    likes = model.MessageLike.__table__
+    paths = archive_handler.segment_paths(group_id)
+    if paths:
+        # an interrupted run may have written the last segment without deleting its rows
+        finish_segment(engine, group_id, paths[-1])
+    last_id = archive_handler.last_archived_id(group_id)
+    with engine.connect() as conn:
+        # first message that is still hot, everything before it goes to the archive
+        first_hot_id = conn.execute(select(func.min(messages.c.id))
+                                    .where(messages.c.group_id == group_id, messages.c.created_at >= cutoff)).scalar()
+        query = select(messages).where(messages.c.group_id == group_id, messages.c.id > last_id) \
+            .order_by(messages.c.id)
+        if first_hot_id is not None:
+            query = query.where(messages.c.id < first_hot_id)
+
+        def records():
+            with engine.connect() as likes_conn:
+                for batch in conn.execute(query.execution_options(yield_per=BATCH_SIZE)).partitions():
+                    batch_likes = {}
+                    batch_ids = [row.id for row in batch]
+                    for like in likes_conn.execute(select(likes).where(likes.c.message_id.in_(batch_ids))
+                                                   .order_by(likes.c.id)):
+                        batch_likes.setdefault(like.message_id, []).append(like)
+                    for row in batch:
+                        yield archive_handler.message_to_record(row, batch_likes.get(row.id, []))
+
+        archived = archive_handler.write_segment(group_id, records())
+    if archived and not finish_segment(engine, group_id, archive_handler.segment_paths(group_id)[-1]):
+        return 0
+    return archived
+
+
+def archive_messages(days: int = config.MESSAGE_ARCHIVE_AFTER_DAYS) -> int:
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    messages = model.Message.__table__
+    archived = 0
+    # the same engine may back several shards, archive each database once
+    for engine in dict.fromkeys(shard_engines):
+        if ids_can_be_reused(engine):
+            raise RuntimeError(f"{engine.url} may reuse message ids, run migrate_messages.py before archiving")
+        with engine.connect() as conn:
+            group_ids = conn.execute(select(messages.c.group_id).distinct()
+                                     .where(messages.c.created_at < cutoff)).scalars().all()
+        for group_id in group_ids:
+            if group_id is not None:
+                archived += archive_group(engine, group_id, cutoff)
+    return archived
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move old group messages into compressed segment files")
+    parser.add_argument("--days", type=int, default=config.MESSAGE_ARCHIVE_AFTER_DAYS,
+                        help="archive messages older than this many days")
+    args = parser.parse_args()
+    print(f"Archived {archive_messages(args.days)} messages")
@@ -0,0 +1,57 @@
+# Measures group message write throughput for different shard counts.
+#
+# Usage:
+#   python bench_shards.py [--groups 16] [--messages 200] [--shards 1 2 4 8]
+#
+# Every run uses fresh sqlite files in a temporary directory. One thread per group posts messages through
+# crud.create_group_message on the shard session of its group, so with more shards fewer writers share a
+# database lock.
+import argparse
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from sqlalchemy.orm import sessionmaker
+import crud
+import model
+import schema
+from db_handler import create_shard_engines, get_shard_index
+
+
+def run(shard_count: int, groups: int, messages: int) -> float:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        urls = [f"sqlite:///{tmp_dir}/shard_{index}.db" for index in range(shard_count)]
+        engines = create_shard_engines(urls)
+        for shard_engine in engines:
+            model.Base.metadata.create_all(bind=shard_engine, tables=model.SHARD_TABLES)
+        sessions = [sessionmaker(autocommit=False, autoflush=False, bind=shard_engine) for shard_engine in engines]
+
+        def post_messages(group_id):
+            user = SimpleNamespace(id=group_id)
+            db = sessions[get_shard_index(group_id, shard_count)]()
+            try:
+                for number in range(messages):
+                    crud.create_group_message(db, schema.MessageCreate(message=f"message {number}"), group_id, user)
+            finally:
+                db.close()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=groups) as executor:
+            list(executor.map(post_messages, range(1, groups + 1)))
+        elapsed = time.perf_counter() - start
+        for shard_engine in engines:
+            shard_engine.dispose()
+    return groups * messages / elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark group message writes against shard count")
+    parser.add_argument("--groups", type=int, default=16)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+    baseline = None
+    for shard_count in args.shards:
+        throughput = run(shard_count, args.groups, args.messages)
+        baseline = baseline or throughput
+        print(f"{shard_count} shard(s): {throughput:8.0f} messages/s  ({throughput / baseline:.2f}x)")
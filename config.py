@@ -4,3 +4,37 @@
 # And replace the below secret key
 SECRET_KEY = "1fe3be0d5f3e8e87e1ed647f2bafef48eabdaabe884a3622e8725d40ec8ff29f"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+
+# Messages older than this are moved out of the database into compressed segment files by archive_messages.py
+MESSAGE_ARCHIVE_AFTER_DAYS = 90
+MESSAGE_ARCHIVE_DIR = "./message_archive"
+
+# Connection pool of every database engine, see db_handler.py
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 10
+DB_POOL_CAPACITY = DB_POOL_SIZE + DB_MAX_OVERFLOW
+
+# Admission control per route class, see admission_handler.py. A request is shed with 503 when its class already
+# has max_in_flight requests running, when max_total_in_flight requests of all classes run together, or when the
+# recent database pool wait, in seconds, is above max_pool_wait of its class. An admitted request holds at most one
+# connection of each pool, so the limits are shares of the pool capacity: more requests could only wait for a
+# connection. ADMISSION_MESSAGES_RESERVE connections are kept for message reads and posts, the other classes
+# together never fill the pool, and admin/user management and search are shed first.
+ADMISSION_MESSAGES_RESERVE = max(1, DB_POOL_CAPACITY // 3)
+ADMISSION_MAX_IN_FLIGHT = DB_POOL_CAPACITY - ADMISSION_MESSAGES_RESERVE
+ADMISSION_LIMITS = {
+    "messages": {"max_in_flight": DB_POOL_CAPACITY, "max_total_in_flight": DB_POOL_CAPACITY, "max_pool_wait": 2.0},
+    "auth": {"max_in_flight": max(1, DB_POOL_CAPACITY // 3), "max_total_in_flight": ADMISSION_MAX_IN_FLIGHT,
+             "max_pool_wait": 1.0},
+    "writes": {"max_in_flight": max(1, DB_POOL_CAPACITY // 3), "max_total_in_flight": ADMISSION_MAX_IN_FLIGHT,
+               "max_pool_wait": 0.5},
+    "reads": {"max_in_flight": max(1, DB_POOL_CAPACITY // 5), "max_total_in_flight": ADMISSION_MAX_IN_FLIGHT,
+              "max_pool_wait": 0.5},
+    "admin": {"max_in_flight": max(1, DB_POOL_CAPACITY // 15), "max_total_in_flight": ADMISSION_MAX_IN_FLIGHT,
+              "max_pool_wait": 0.2},
+    "search": {"max_in_flight": max(1, DB_POOL_CAPACITY // 15), "max_total_in_flight": ADMISSION_MAX_IN_FLIGHT,
+               "max_pool_wait": 0.2},
+}
+ADMISSION_RETRY_AFTER_SECONDS = 1
+# Pool wait samples lose half their weight after this many seconds, so shedding stops once the load is gone
+ADMISSION_POOL_WAIT_HALF_LIFE_SECONDS = 2.0
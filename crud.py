@@ -1,12 +1,18 @@
+import json
+from datetime import datetime
 from fastapi import HTTPException, Depends
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 import model
 import schema
 import config
+import archive_handler
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 
+EXPORT_BATCH_SIZE = 1000
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -148,8 +154,22 @@ def create_group_message(db: Session, message: schema.MessageCreate, group_id: i
     return db_message
 
 
-def get_group_message(db, message_id):
-    return db.query(model.Message).filter(model.Message.id == message_id).first()
+def get_group_message(db, group_id, message_id):
+    # message ids are only unique within a shard, so always look them up together with their group
+    return db.query(model.Message).filter(model.Message.id == message_id, model.Message.group_id == group_id).first()
+
+
+def get_group_messages(db: Session, group_id: int, before_id: int = None, limit: int = 50):
+    # Newest first. Archived messages all have lower ids than hot ones, so once the hot table runs out the
+    # page is filled up from the archive.
+    query = db.query(model.Message).filter(model.Message.group_id == group_id)
+    if before_id is not None:
+        query = query.filter(model.Message.id < before_id)
+    messages = query.order_by(model.Message.id.desc()).limit(limit).all()
+    if len(messages) < limit:
+        archive_before_id = messages[-1].id if messages else before_id
+        messages += archive_handler.read_messages(group_id, before_id=archive_before_id, limit=limit - len(messages))
+    return messages
 
 
 def like_group_message(db: Session, message_id: int, user: model.User):
@@ -166,3 +186,55 @@ def like_group_message(db: Session, message_id: int, user: model.User):
 
 def search_groups(db: Session, name: str):
     return db.query(model.Group).filter(model.Group.name.contains(name)).all()
+
+
+def export_group_history(db: Session, group_id: int):
+    # Rows are read through a server side cursor EXPORT_BATCH_SIZE at a time and written out as NDJSON lines,
+    # all messages first in id order and then their likes, so memory use does not depend on the group size.
+    # Archived messages come before the hot ones as they have lower ids. The segments are listed once, hot rows
+    # are read above their last id, and an archive run that moves rows meanwhile fails the export, as those rows
+    # would be missing. A last end row with the counts tells a complete export from a cut off one.
+    def to_line(row):
+        return json.dumps(row, default=datetime.isoformat) + "\n"
+
+    paths = archive_handler.segment_paths(group_id)
+    archived_up_to = archive_handler.last_archived_id(group_id, paths=paths)
+    counts = {"messages": 0, "likes": 0}
+    batch = []
+    for record in archive_handler.iter_records(group_id, paths=paths):
+        batch.append(to_line({"type": "message", **{key: value for key, value in record.items() if key != "likes"}}))
+        counts["messages"] += 1
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            yield "".join(batch)
+            batch.clear()
+    yield "".join(batch)
+    messages = select(model.Message.id, model.Message.group_id, model.Message.user_id, model.Message.message,
+                      model.Message.created_at) \
+        .where(model.Message.group_id == group_id, model.Message.id > archived_up_to).order_by(model.Message.id)
+    last_message_id = None
+    for rows in db.execute(messages.execution_options(yield_per=EXPORT_BATCH_SIZE)).partitions():
+        yield "".join(to_line({"type": "message", **row._asdict()}) for row in rows)
+        counts["messages"] += len(rows)
+        last_message_id = rows[-1].id
+    batch = []
+    for record in archive_handler.iter_records(group_id, paths=paths):
+        for like in record["likes"]:
+            batch.append(to_line({"type": "like", "message_id": record["id"], **like}))
+            counts["likes"] += 1
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            yield "".join(batch)
+            batch.clear()
+    yield "".join(batch)
+    if last_message_id is not None:
+        # only likes of messages written above, not of messages posted while the export was running
+        likes = select(model.MessageLike.id, model.MessageLike.message_id, model.MessageLike.user_id) \
+            .join(model.Message, model.MessageLike.message_id == model.Message.id) \
+            .where(model.Message.group_id == group_id, model.Message.id > archived_up_to,
+                   model.Message.id <= last_message_id) \
+            .order_by(model.MessageLike.id)
+        for rows in db.execute(likes.execution_options(yield_per=EXPORT_BATCH_SIZE)).partitions():
+            yield "".join(to_line({"type": "like", **row._asdict()}) for row in rows)
+            counts["likes"] += len(rows)
+    if archive_handler.last_archived_id(group_id) != archived_up_to:
+        raise RuntimeError(f"Messages of group {group_id} were archived during the export, export it again")
+    yield to_line({"type": "end", **counts})
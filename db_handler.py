@@ -1,3 +1,5 @@
+import zlib
+import config
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
@@ -10,7 +12,7 @@ SQLALCHEMY_DATABASE_URL = "sqlite:///./chat_database.db"
 # By default, check_same_thread is True and only the creating thread may use the connection. If set False,
 # the returned connection may be shared across multiple threads
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL
+    SQLALCHEMY_DATABASE_URL, pool_size=config.DB_POOL_SIZE, max_overflow=config.DB_MAX_OVERFLOW
 )
 
 # bind – An optional Connectable, will be assigned the bind attribute on the MetaData instance.
@@ -18,3 +20,39 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 # A simple constructor that allows initialization from kwargs.
 Base = declarative_base()
+
+# Group messages and likes are spread over these databases by group_id hash. Every url gets its own engine and
+# connection pool, so writes for groups living in different shards do not wait on each other. Reusing
+# SQLALCHEMY_DATABASE_URL keeps a shard in the main database. After changing this list run rebalance_shards.py
+# so existing messages are moved to their new shard.
+SHARD_DATABASE_URLS = [
+    SQLALCHEMY_DATABASE_URL,
+    # "sqlite:///./chat_shard_1.db",
+    # "sqlite:///./chat_shard_2.db",
+]
+
+
+def create_shard_engines(urls):
+    engines = {SQLALCHEMY_DATABASE_URL: engine}
+    for url in urls:
+        if url not in engines:
+            engines[url] = create_engine(url, pool_size=config.DB_POOL_SIZE, max_overflow=config.DB_MAX_OVERFLOW)
+    return [engines[url] for url in urls]
+
+
+def get_shard_index(group_id: int, shard_count: int) -> int:
+    # crc32 is stable across processes, unlike hash() on str
+    return zlib.crc32(str(group_id).encode()) % shard_count
+
+
+shard_engines = create_shard_engines(SHARD_DATABASE_URLS)
+ShardSessionLocal = [sessionmaker(autocommit=False, autoflush=False, bind=shard_engine)
+                     for shard_engine in shard_engines]
+
+
+def get_shard_engine(group_id: int):
+    return shard_engines[get_shard_index(group_id, len(shard_engines))]
+
+
+def get_shard_session(group_id: int):
+    return ShardSessionLocal[get_shard_index(group_id, len(ShardSessionLocal))]()
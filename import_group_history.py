@@ -0,0 +1,128 @@
+# Bulk loads a group history exported from GET /groups/{group_id}/export into the shard of the group.
+#
+# Usage:
+#   python import_group_history.py export.ndjson [--group-id 7]
+#
+# Run it with the application stopped. The file is read line by line and inserted IMPORT_BATCH_SIZE rows at a time,
+# so memory use stays the same however large the file is. All batches are committed together at the end, so a bad
+# line leaves the shard as it was and the import can simply be run again. Secondary indexes on the messages and
+# likes tables are dropped for the load and built again once at the end. Message ids are shifted past the ids
+# already in the shard and in the group archive by a single offset, which keeps their order and lets likes be
+# remapped without an id lookup table. Files without the end row of a finished export are rejected.
+import argparse
+import json
+import sys
+from datetime import datetime
+from sqlalchemy import select, func
+import archive_handler
+import crud
+import model
+from db_handler import SessionLocal, get_shard_engine
+
+IMPORT_BATCH_SIZE = 10000
+
+
+def import_group_history(lines, group_id: int = None) -> dict:
+    messages = model.Message.__table__
+    likes = model.MessageLike.__table__
+    counts = {"messages": 0, "likes": 0}
+    offset = None
+    first_id = None
+    last_id = None
+    batch = []
+    conn = None
+    ended = False
+
+    def flush(table):
+        if not batch:
+            return
+        if table is likes:
+            # imported ids are above every id the shard had before, so these are messages of this import
+            message_ids = {like["message_id"] for like in batch}
+            imported = set(conn.execute(select(messages.c.id).where(messages.c.group_id == group_id,
+                                                                    messages.c.id.in_(message_ids))).scalars())
+            for message_id in message_ids - imported:
+                raise ValueError(f"Like of message {message_id - offset} whose message is not in the file")
+        conn.execute(table.insert(), batch)
+        batch.clear()
+
+    try:
+        for line_number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if ended:
+                raise ValueError(f"Line {line_number}: rows found after the end row")
+            if row["type"] == "end":
+                if (row["messages"], row["likes"]) != (counts["messages"], counts["likes"]):
+                    raise ValueError(f"Line {line_number}: end row counts do not match the file")
+                ended = True
+            elif row["type"] == "message":
+                if counts["likes"]:
+                    raise ValueError(f"Line {line_number}: message found after likes")
+                if conn is None:
+                    group_id = group_id or row["group_id"]
+                    db = SessionLocal()
+                    try:
+                        if not crud.get_group(db, group_id=group_id):
+                            raise ValueError(f"Group {group_id} not found")
+                    finally:
+                        db.close()
+                    engine = get_shard_engine(group_id)
+                    model.Base.metadata.create_all(bind=engine, tables=model.SHARD_TABLES)
+                    conn = engine.connect()
+                    for index in list(messages.indexes) + list(likes.indexes):
+                        index.drop(bind=conn, checkfirst=True)
+                    conn.commit()
+                    max_id = conn.execute(select(func.max(messages.c.id))).scalar() or 0
+                    max_id = max(max_id, archive_handler.last_archived_id(group_id))
+                    offset = max_id + 1 - row["id"]
+                    first_id = row["id"]
+                if last_id is not None and row["id"] <= last_id:
+                    raise ValueError(f"Line {line_number}: messages must be in increasing id order")
+                last_id = row["id"]
+                created_at = datetime.fromisoformat(row["created_at"]) if row.get("created_at") else datetime.utcnow()
+                batch.append({"id": row["id"] + offset, "group_id": group_id, "user_id": row["user_id"],
+                              "message": row["message"], "created_at": created_at})
+                counts["messages"] += 1
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    flush(messages)
+            elif row["type"] == "like":
+                if conn is None:
+                    raise ValueError(f"Line {line_number}: like found before any message")
+                if not first_id <= row["message_id"] <= last_id:
+                    raise ValueError(f"Line {line_number}: like of message {row['message_id']} not in the file")
+                if counts["likes"] == 0:
+                    flush(messages)
+                batch.append({"message_id": row["message_id"] + offset, "user_id": row["user_id"]})
+                counts["likes"] += 1
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    flush(likes)
+            else:
+                raise ValueError(f"Line {line_number}: unknown row type {row['type']}")
+        if not ended:
+            raise ValueError("File has no end row, the export did not finish")
+        if conn is not None:
+            flush(likes if counts["likes"] else messages)
+            conn.commit()
+    finally:
+        if conn is not None:
+            conn.rollback()
+            for index in list(messages.indexes) + list(likes.indexes):
+                index.create(bind=conn, checkfirst=True)
+            conn.commit()
+            conn.close()
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk load an NDJSON group history export")
+    parser.add_argument("path", help="NDJSON file written by GET /groups/{group_id}/export, - for stdin")
+    parser.add_argument("--group-id", type=int, help="group to load the history into, defaults to the exported one")
+    args = parser.parse_args()
+    if args.path == "-":
+        counts = import_group_history(sys.stdin, group_id=args.group_id)
+    else:
+        with open(args.path, encoding="utf-8") as history:
+            counts = import_group_history(history, group_id=args.group_id)
+    print(f"Imported {counts['messages']} messages and {counts['likes']} likes")
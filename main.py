@@ -1,5 +1,8 @@
 from datetime import timedelta
-from fastapi import Depends, FastAPI, HTTPException
+from typing import List
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.orm import Session
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 import crud
@@ -7,9 +10,16 @@ import model
 import schema
 import config
 import utils
-from db_handler import SessionLocal, engine
+import admission_handler
+import migrate_messages
+from db_handler import SessionLocal, engine, shard_engines, get_shard_engine, get_shard_session
 
 model.Base.metadata.create_all(bind=engine)
+for shard_engine in shard_engines:
+    model.Base.metadata.create_all(bind=shard_engine, tables=model.SHARD_TABLES)
+for shard_engine in dict.fromkeys([engine] + shard_engines):
+    migrate_messages.add_created_at(shard_engine)
+    migrate_messages.add_missing_indexes(shard_engine)
 
 # initiating app
 app = FastAPI(
@@ -17,18 +27,45 @@ app = FastAPI(
     description="A chatting app where people can chat in any group",
     version="1.0.0"
 )
+app.add_middleware(admission_handler.AdmissionMiddleware)
 model.Base.metadata.create_all(bind=engine)
 
 
+# Checks out the connection right away to record how long the request waited for the pool
+def connect(db: Session, request: Request):
+    try:
+        with admission_handler.measure_pool_wait(getattr(request.state, "route_class", None)):
+            db.connection()
+    except PoolTimeoutError:
+        raise HTTPException(status_code=503, detail="Server is busy, try again later",
+                            headers={"Retry-After": str(config.ADMISSION_RETRY_AFTER_SECONDS)})
+
+
 # Dependency
-def get_db():
+def get_db(request: Request):
     db = SessionLocal()
     try:
+        connect(db, request)
         yield db
     finally:
         db.close()
 
 
+# Session on the shard holding the messages of group_id. When that shard is the main database the request
+# session is reused, holding two connections of one pool per request could exhaust the pool with every request
+# waiting for its second connection.
+def get_shard_db(group_id: int, request: Request, db: Session = Depends(get_db)):
+    if get_shard_engine(group_id) is engine:
+        yield db
+        return
+    shard_db = get_shard_session(group_id)
+    try:
+        connect(shard_db, request)
+        yield shard_db
+    finally:
+        shard_db.close()
+
+
 crud.create_admin_user(db=SessionLocal())
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -65,6 +102,14 @@ def update_user(user_id: int, user: schema.UserUpdate, db: Session = Depends(get
     return crud.update_user(db=db, user_id=user_id, user=user)
 
 
+@app.get("/admission/metrics")
+def get_admission_metrics(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
+    current_user = crud.get_current_user(db, token=token)
+    if not current_user.is_admin:
+        raise HTTPException(status_code=400, detail="You dont have admin role")
+    return admission_handler.get_metrics()
+
+
 @app.post("/groups/", response_model=schema.Group)
 def create_group(group: schema.GroupCreate, db: Session = Depends(get_db),
                  token: str = Depends(oauth2_scheme)):
@@ -145,7 +190,7 @@ def remove_member_from_group(group_id: int, user_id: int, db: Session = Depends(
 # Group Messages
 @app.post("/groups/{group_id}/messages/", response_model=schema.GroupMessage)
 def create_group_message(group_id: int, message: schema.MessageCreate, db: Session = Depends(get_db),
-                         token: str = Depends(oauth2_scheme)):
+                         shard_db: Session = Depends(get_shard_db), token: str = Depends(oauth2_scheme)):
     current_user = crud.get_current_user(db, token=token)
     if current_user.is_admin:
         raise HTTPException(status_code=400, detail="Admin cant create Group messages")
@@ -154,12 +199,27 @@ def create_group_message(group_id: int, message: schema.MessageCreate, db: Sessi
         raise HTTPException(status_code=404, detail="Group not found")
     if not crud.is_member_of_group(db, group=group, user=current_user):
         raise HTTPException(status_code=403, detail="You are not a member of this group")
-    return crud.create_group_message(db=db, message=message, group_id=group_id, user=current_user)
+    return crud.create_group_message(db=shard_db, message=message, group_id=group_id, user=current_user)
+
+
+@app.get("/groups/{group_id}/messages/", response_model=List[schema.GroupMessage])
+def get_group_messages(group_id: int, before_id: int = None, limit: int = Query(default=50, ge=1, le=100),
+                       db: Session = Depends(get_db), shard_db: Session = Depends(get_shard_db),
+                       token: str = Depends(oauth2_scheme)):
+    current_user = crud.get_current_user(db, token=token)
+    if current_user.is_admin:
+        raise HTTPException(status_code=400, detail="Admin cant read Group messages")
+    group = crud.get_group(db, group_id=group_id)
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
+    if not crud.is_member_of_group(db, group=group, user=current_user):
+        raise HTTPException(status_code=403, detail="You are not a member of this group")
+    return crud.get_group_messages(shard_db, group_id=group_id, before_id=before_id, limit=limit)
 
 
 @app.post("/groups/{group_id}/messages/{message_id}/likes/", response_model=schema.MessageLike)
 def like_group_message(group_id: int, message_id: int, db: Session = Depends(get_db),
-                       token: str = Depends(oauth2_scheme)):
+                       shard_db: Session = Depends(get_shard_db), token: str = Depends(oauth2_scheme)):
     current_user = crud.get_current_user(db, token=token)
     if current_user.is_admin:
         raise HTTPException(status_code=400, detail="Admin cant like messages")
@@ -168,10 +228,25 @@ def like_group_message(group_id: int, message_id: int, db: Session = Depends(get
         raise HTTPException(status_code=404, detail="Group not found")
     if not crud.is_member_of_group(db, group=group, user=current_user):
         raise HTTPException(status_code=403, detail="You are not a member of this group")
-    message = crud.get_group_message(db, message_id=message_id)
+    message = crud.get_group_message(shard_db, group_id=group_id, message_id=message_id)
     if not message:
         raise HTTPException(status_code=404, detail="Message not found")
-    return crud.like_group_message(db=db, message_id=message_id, user=current_user)
+    return crud.like_group_message(db=shard_db, message_id=message_id, user=current_user)
+
+
+@app.get("/groups/{group_id}/export")
+def export_group_history(group_id: int, db: Session = Depends(get_db), shard_db: Session = Depends(get_shard_db),
+                         token: str = Depends(oauth2_scheme)):
+    current_user = crud.get_current_user(db, token=token)
+    if current_user.is_admin:
+        raise HTTPException(status_code=400, detail="Admin cant export Group history")
+    group = crud.get_group(db, group_id=group_id)
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
+    if not crud.is_member_of_group(db, group=group, user=current_user):
+        raise HTTPException(status_code=403, detail="You are not a member of this group")
+    return StreamingResponse(crud.export_group_history(shard_db, group_id=group_id),
+                             media_type="application/x-ndjson")
 
 
 if __name__ == "__main__":
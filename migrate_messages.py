@@ -0,0 +1,85 @@
+# Brings messages tables created before the message archive up to date.
+#
+# Usage:
+#   python migrate_messages.py
+#
+# add_created_at and add_missing_indexes run on every start of the application as well. Existing messages get the
+# time of the migration as created_at, as the time they were posted was never stored. rebuild_with_autoincrement is
+# needed before archive_messages.py can run on sqlite databases created before the archive, run it with the
+# application stopped.
+from datetime import datetime
+from sqlalchemy import MetaData, inspect, text
+import model
+from db_handler import engine, shard_engines
+
+
+def add_created_at(bind) -> bool:
+    if "created_at" in [column["name"] for column in inspect(bind).get_columns("messages")]:
+        return False
+    column_type = model.Message.__table__.c.created_at.type.compile(dialect=bind.dialect)
+    with bind.begin() as conn:
+        conn.execute(text(f"ALTER TABLE messages ADD COLUMN created_at {column_type}"))
+        conn.execute(text("UPDATE messages SET created_at = :now WHERE created_at IS NULL"),
+                     {"now": datetime.utcnow()})
+    return True
+
+
+def add_missing_indexes(bind) -> list:
+    # create_all skips tables that already exist, indexes added to them later are created here
+    created = []
+    with bind.connect() as conn:
+        for table in model.SHARD_TABLES:
+            existing = {index["name"] for index in inspect(conn).get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(bind=conn, checkfirst=True)
+                    created.append(index.name)
+        conn.commit()
+    return created
+
+
+def ids_can_be_reused(bind) -> bool:
+    # The archive needs message ids that are never handed out again once the newest messages are archived
+    if bind.dialect.name == "sqlite":
+        with bind.connect() as conn:
+            sql = conn.execute(text("SELECT sql FROM sqlite_master "
+                                    "WHERE type = 'table' AND name = 'messages'")).scalar()
+        return "AUTOINCREMENT" not in (sql or "").upper()
+    if bind.dialect.name == "mysql":
+        # before 8.0 InnoDB resets AUTO_INCREMENT to max(id) + 1 on restart
+        with bind.connect():
+            return bind.dialect.server_version_info < (8, 0)
+    return False
+
+
+def rebuild_with_autoincrement(bind) -> bool:
+    if bind.dialect.name != "sqlite" or not ids_can_be_reused(bind):
+        return False
+    messages = model.Message.__table__
+    new_messages = messages.to_metadata(MetaData(), name="messages_new")
+    # index names are shared by the whole database, the indexes are created again once the old table is gone
+    new_messages.indexes.clear()
+    with bind.connect() as conn:
+        new_messages.drop(bind=conn, checkfirst=True)
+        new_messages.create(bind=conn)
+        columns = ", ".join(column.name for column in messages.columns)
+        # pysqlite begins the transaction at the INSERT, so the copy, drop and rename commit together
+        conn.execute(text(f"INSERT INTO messages_new ({columns}) SELECT {columns} FROM messages"))
+        conn.execute(text("DROP TABLE messages"))
+        conn.execute(text("ALTER TABLE messages_new RENAME TO messages"))
+        conn.commit()
+        for index in messages.indexes:
+            index.create(bind=conn, checkfirst=True)
+        conn.commit()
+    return True
+
+
+if __name__ == "__main__":
+    # the same engine may back several shards, migrate each database once
+    for bind in dict.fromkeys([engine] + shard_engines):
+        added = add_created_at(bind)
+        rebuilt = rebuild_with_autoincrement(bind)
+        indexes = add_missing_indexes(bind)
+        print(f"{bind.url}: created_at {'added' if added else 'present'}, "
+              f"autoincrement {'rebuilt' if rebuilt else 'not needed'}, "
+              f"indexes {', '.join(indexes) if indexes else 'present'}")
@@ -1,4 +1,5 @@
-from sqlalchemy import Boolean, Column, Integer, String, ForeignKey
+from datetime import datetime
+from sqlalchemy import Boolean, Column, Integer, String, ForeignKey, DateTime, Index
 from db_handler import Base
 from sqlalchemy.orm import relationship
 
@@ -26,7 +27,7 @@ class Group(Base):
     owner_id = Column(Integer, ForeignKey("users.id"))
 
     members = relationship("GroupMember", back_populates="group")
-    messages = relationship("Message", back_populates="group")
+    messages = relationship("Message", back_populates="group", primaryjoin="Group.id == foreign(Message.group_id)")
 
 
 class GroupMember(Base):
@@ -42,14 +43,20 @@ class GroupMember(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    # History is paged by id within a group. sqlite_autoincrement stops sqlite from handing out ids again
+    # once the newest messages have been moved to the archive.
+    __table_args__ = (Index("ix_messages_group_id_id", "group_id", "id"), {"sqlite_autoincrement": True})
 
+    # Messages may live in a shard database without the groups and users tables, so group_id and user_id
+    # carry no foreign keys
     id = Column(Integer, primary_key=True, autoincrement=True, index=True, nullable=False)
-    group_id = Column(Integer, ForeignKey("groups.id"))
-    user_id = Column(Integer, ForeignKey("users.id"))
+    group_id = Column(Integer)
+    user_id = Column(Integer)
     message = Column(String(250))
+    created_at = Column(DateTime, default=datetime.utcnow)
 
-    group = relationship("Group", back_populates="messages")
-    user = relationship("User")
+    group = relationship("Group", back_populates="messages", primaryjoin="Group.id == foreign(Message.group_id)")
+    user = relationship("User", primaryjoin="User.id == foreign(Message.user_id)")
     likes = relationship("MessageLike", back_populates="message")
 
 
@@ -58,7 +65,11 @@ class MessageLike(Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True, index=True, nullable=False)
     message_id = Column(Integer, ForeignKey("messages.id"))
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer)
 
     message = relationship("Message", back_populates="likes")
-    user = relationship("User")
+    user = relationship("User", primaryjoin="User.id == foreign(MessageLike.user_id)")
+
+
+# Tables created in every shard database, the rest of the schema only lives in the main database
+SHARD_TABLES = [Message.__table__, MessageLike.__table__]
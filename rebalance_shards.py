@@ -0,0 +1,124 @@
+# Moves group messages and likes to the shard their group hashes to under a new list of shard urls.
+#
+# Usage:
+#   python rebalance_shards.py --old sqlite:///./chat_database.db \
+#       --new sqlite:///./chat_database.db sqlite:///./chat_shard_1.db sqlite:///./chat_shard_2.db
+#
+# Run it with the application stopped, then put the --new list into SHARD_DATABASE_URLS in db_handler.py.
+# Message ids are only unique within a shard, so moved messages get new ids in their target shard, above any
+# archived message of the group, and the likes pointing at them are rewritten to match. Each group is copied and
+# committed on the target shard before it is deleted from the source shard. If a run is interrupted, run it again
+# with the same arguments: copies already made are recorded on the target and are finished, not repeated.
+import argparse
+from sqlalchemy import select, delete, func, Table, MetaData, Column, Integer, String
+import archive_handler
+import model
+from db_handler import create_shard_engines, get_shard_index
+
+BATCH_SIZE = 1000
+
+# Journal on the target shard of the source messages already copied there. It is written in the same
+# transaction as the copies, so a rerun after a crash skips them, and it is cleared once the source rows are gone.
+shard_moves = Table(
+    "shard_moves", MetaData(),
+    Column("source", String(250), primary_key=True),
+    Column("source_message_id", Integer, primary_key=True),
+    Column("group_id", Integer, index=True),
+    Column("target_message_id", Integer),
+)
+
+
+def copy_group(source, target, group_id: int) -> int:
+    messages = model.Message.__table__
+    likes = model.MessageLike.__table__
+    source_key = str(source.url)
+    copied = 0
+    with source.connect() as source_conn, source.connect() as likes_conn, target.begin() as target_conn:
+        # new ids have to stay above the archived ids of the group, see archive_messages.py
+        next_id = max(target_conn.execute(select(func.max(messages.c.id))).scalar() or 0,
+                      archive_handler.last_archived_id(group_id)) + 1
+        rows = source_conn.execute(select(messages).where(messages.c.group_id == group_id).order_by(messages.c.id))
+        for batch in rows.partitions(BATCH_SIZE):
+            copied_ids = set(target_conn.execute(
+                select(shard_moves.c.source_message_id)
+                .where(shard_moves.c.source == source_key,
+                       shard_moves.c.source_message_id.in_([row.id for row in batch]))).scalars())
+            message_ids = {}
+            new_messages = []
+            for row in batch:
+                if row.id in copied_ids:
+                    continue
+                new_messages.append({"id": next_id, "group_id": row.group_id, "user_id": row.user_id,
+                                     "message": row.message, "created_at": row.created_at})
+                message_ids[row.id] = next_id
+                next_id += 1
+            if not new_messages:
+                continue
+            target_conn.execute(messages.insert(), new_messages)
+            like_rows = likes_conn.execute(select(likes).where(likes.c.message_id.in_(list(message_ids))))
+            new_likes = [{"message_id": message_ids[like.message_id], "user_id": like.user_id}
+                         for like in like_rows]
+            if new_likes:
+                target_conn.execute(likes.insert(), new_likes)
+            target_conn.execute(shard_moves.insert(), [
+                {"source": source_key, "source_message_id": old_id, "group_id": group_id, "target_message_id": new_id}
+                for old_id, new_id in message_ids.items()])
+            copied += len(new_messages)
+    return copied
+
+
+def delete_moved(source, target, group_id: int) -> None:
+    messages = model.Message.__table__
+    likes = model.MessageLike.__table__
+    journal = (shard_moves.c.source == str(source.url)) & (shard_moves.c.group_id == group_id)
+    with target.connect() as target_conn, source.begin() as source_conn:
+        moved_ids = target_conn.execute(select(shard_moves.c.source_message_id).where(journal))
+        for batch in moved_ids.scalars().partitions(BATCH_SIZE):
+            source_conn.execute(delete(likes).where(likes.c.message_id.in_(batch)))
+            source_conn.execute(delete(messages).where(messages.c.id.in_(batch)))
+    with target.begin() as target_conn:
+        target_conn.execute(delete(shard_moves).where(journal))
+
+
+def move_group(source, target, group_id: int) -> int:
+    moved = copy_group(source, target, group_id)
+    delete_moved(source, target, group_id)
+    return moved
+
+
+def rebalance(old_urls, new_urls) -> int:
+    old_engines = create_shard_engines(old_urls)
+    new_engines = create_shard_engines(new_urls)
+    for shard_engine in new_engines:
+        model.Base.metadata.create_all(bind=shard_engine, tables=model.SHARD_TABLES)
+        shard_moves.create(bind=shard_engine, checkfirst=True)
+    messages = model.Message.__table__
+    # the same database may appear more than once in a list, handle each one only once
+    sources = {str(source.url): (source_url, source) for source_url, source in zip(old_urls, old_engines)}
+    # finish the deletes of a run that stopped after copying
+    for target in dict.fromkeys(new_engines):
+        with target.connect() as conn:
+            pending = conn.execute(select(shard_moves.c.source, shard_moves.c.group_id).distinct()).all()
+        for source_key, group_id in pending:
+            if source_key in sources:
+                delete_moved(sources[source_key][1], target, group_id)
+    moved = 0
+    for source_url, source in sources.values():
+        with source.connect() as conn:
+            group_ids = conn.execute(select(messages.c.group_id).distinct()).scalars().all()
+        for group_id in group_ids:
+            if group_id is None:
+                continue
+            target_index = get_shard_index(group_id, len(new_urls))
+            if new_urls[target_index] == source_url:
+                continue
+            moved += move_group(source, new_engines[target_index], group_id)
+    return moved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move group messages to their shard under a new shard list")
+    parser.add_argument("--old", nargs="+", required=True, help="shard urls messages are currently stored in")
+    parser.add_argument("--new", nargs="+", required=True, help="shard urls messages should be stored in")
+    args = parser.parse_args()
+    print(f"Moved {rebalance(args.old, args.new)} messages")
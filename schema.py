@@ -1,3 +1,4 @@
+from datetime import datetime
 from typing import Optional, List
 from pydantic import BaseModel
 
@@ -82,6 +83,7 @@ class GroupMessage(MessageBase):
     id: int
     group_id: int
     user_id: int
+    created_at: datetime = None
 
     class Config:
         orm_mode = True
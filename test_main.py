@@ -1,6 +1,23 @@
 # End-to-End Tests
+import json
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+import pytest
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
 import main
+import crud
+import db_handler
+import archive_handler
+import admission_handler
+import config
+import model
+import rebalance_shards
+import import_group_history
+import archive_messages
+import migrate_messages
 
 client = TestClient(main.app)
 
@@ -161,8 +178,353 @@ def test_like_message_for_admin():
     assert response.status_code == 400
 
 
+def test_get_group_messages():
+    header = user_authentication_headers("testuser", "password")
+    response = client.get("/groups/1/messages/", headers=header)
+    assert response.status_code == 200
+    assert response.json()[0]["message"] == "TestMessage"
+    response = client.get(f"/groups/1/messages/?before_id={response.json()[0]['id']}", headers=header)
+    assert response.status_code == 200
+    assert response.json() == []
+
+
+def test_export_group_history():
+    header = user_authentication_headers("testuser", "password")
+    response = client.get("/groups/1/export", headers=header)
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert rows[0]["type"] == "message"
+    assert rows[0]["message"] == "TestMessage"
+    assert rows[-2]["type"] == "like"
+    assert rows[-2]["message_id"] == rows[0]["id"]
+    assert rows[-1] == {"type": "end", "messages": 1, "likes": 1}
+
+
+def test_export_group_history_for_admin():
+    header = user_authentication_headers("admin", "admin")
+    response = client.get("/groups/1/export", headers=header)
+    assert response.status_code == 400
+
+
 def test_delete_group():
     header = user_authentication_headers("testuser", "password")
     response = client.delete("/groups/1", headers=header)
     assert response.status_code == 200
     assert response.json() == {"message": "Group deleted"}
+
+
+def test_messages_are_written_to_and_rebalanced_between_shards(tmp_path, monkeypatch):
+    shard_url = f"sqlite:///{tmp_path}/shard_1.db"
+    shard_engine = sqlalchemy.create_engine(shard_url)
+    model.Base.metadata.create_all(bind=shard_engine, tables=model.SHARD_TABLES)
+    monkeypatch.setattr(db_handler, "shard_engines", [db_handler.engine, shard_engine])
+    monkeypatch.setattr(db_handler, "ShardSessionLocal", [db_handler.SessionLocal, sessionmaker(bind=shard_engine)])
+    assert sqlalchemy.inspect(shard_engine).get_table_names() == ["message_likes", "messages"]
+
+    header = user_authentication_headers("testuser", "password")
+    group_id = None
+    for number in range(20):
+        response = client.post("/groups/", json={"name": f"shardgroup{number}"}, headers=header)
+        if db_handler.get_shard_index(response.json()["id"], 2) == 1:
+            group_id = response.json()["id"]
+            break
+    response = client.post(f"/groups/{group_id}/messages/", json={"message": "Sharded"}, headers=header)
+    assert response.status_code == 200
+    message_id = response.json()["id"]
+    response = client.post(f"/groups/{group_id}/messages/{message_id}/likes/", headers=header)
+    assert response.status_code == 200
+
+    def count(engine, table):
+        with engine.connect() as conn:
+            return conn.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(table)
+                                .where(table.c.group_id == group_id)).scalar()
+
+    messages = model.Message.__table__
+    assert count(shard_engine, messages) == 1
+    assert count(db_handler.engine, messages) == 0
+
+    # a rebalance interrupted after copying is finished by the next run without copying twice
+    main_url = db_handler.SQLALCHEMY_DATABASE_URL
+    new_engines = db_handler.create_shard_engines([main_url])
+    rebalance_shards.shard_moves.create(bind=new_engines[0], checkfirst=True)
+    assert rebalance_shards.copy_group(shard_engine, new_engines[0], group_id) == 1
+    assert rebalance_shards.rebalance([main_url, shard_url], [main_url]) == 0
+    assert count(shard_engine, messages) == 0
+    assert count(db_handler.engine, messages) == 1
+    with db_handler.engine.connect() as conn:
+        moved_id = conn.execute(sqlalchemy.select(messages.c.id).where(messages.c.group_id == group_id)).scalar()
+        likes = model.MessageLike.__table__
+        assert conn.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(likes)
+                            .where(likes.c.message_id == moved_id)).scalar() == 1
+        assert conn.execute(sqlalchemy.select(sqlalchemy.func.count())
+                            .select_from(rebalance_shards.shard_moves)).scalar() == 0
+
+
+def test_export_import_round_trip(monkeypatch):
+    monkeypatch.setattr(import_group_history, "IMPORT_BATCH_SIZE", 2)
+    header = user_authentication_headers("testuser", "password")
+    source_id = client.post("/groups/", json={"name": "exportgroup"}, headers=header).json()["id"]
+    target_id = client.post("/groups/", json={"name": "importgroup"}, headers=header).json()["id"]
+    for number in range(3):
+        message_id = client.post(f"/groups/{source_id}/messages/", json={"message": f"Export {number}"},
+                                 headers=header).json()["id"]
+    client.post(f"/groups/{source_id}/messages/{message_id}/likes/", headers=header)
+    lines = client.get(f"/groups/{source_id}/export", headers=header).text.splitlines()
+
+    counts = import_group_history.import_group_history(lines, group_id=target_id)
+    assert counts == {"messages": 3, "likes": 1}
+    imported = client.get(f"/groups/{target_id}/messages/", headers=header).json()
+    assert [message["message"] for message in imported] == ["Export 2", "Export 1", "Export 0"]
+    rows = [json.loads(line) for line in client.get(f"/groups/{target_id}/export", headers=header).text.splitlines()]
+    assert rows[-2]["type"] == "like"
+    assert rows[-2]["message_id"] == imported[0]["id"]
+
+    # a bad line rolls back the batches before it
+    with pytest.raises(ValueError):
+        import_group_history.import_group_history(lines[:3] + ['{"type": "unknown"}'], group_id=target_id)
+    assert len(client.get(f"/groups/{target_id}/messages/", headers=header).json()) == 3
+    # so does a like whose message is not in the file
+    dangling = json.dumps({"type": "like", "id": 1, "message_id": json.loads(lines[0])["id"] - 1, "user_id": 2})
+    with pytest.raises(ValueError):
+        import_group_history.import_group_history(lines[:3] + [dangling], group_id=target_id)
+    gap = [json.dumps({"type": "message", "id": message_id, "group_id": source_id, "user_id": 2, "message": "Gap"})
+           for message_id in (10, 12)] + [json.dumps({"type": "like", "id": 1, "message_id": 11, "user_id": 2}),
+                                          json.dumps({"type": "end", "messages": 2, "likes": 1})]
+    with pytest.raises(ValueError):
+        import_group_history.import_group_history(gap, group_id=target_id)
+    # and a file cut off before the end row
+    with pytest.raises(ValueError):
+        import_group_history.import_group_history(lines[:-1], group_id=target_id)
+    with pytest.raises(ValueError):
+        import_group_history.import_group_history(lines[:3] + lines[-1:], group_id=target_id)
+    assert len(client.get(f"/groups/{target_id}/messages/", headers=header).json()) == 3
+
+    # a message posted and liked while the export runs is left out together with its like
+    db = db_handler.SessionLocal()
+    try:
+        export = crud.export_group_history(db, source_id)
+        chunks = [next(export), next(export)]
+        late_id = client.post(f"/groups/{source_id}/messages/", json={"message": "Late"}, headers=header).json()["id"]
+        client.post(f"/groups/{source_id}/messages/{late_id}/likes/", headers=header)
+        rows = [json.loads(line) for line in "".join(chunks + list(export)).splitlines()]
+    finally:
+        db.close()
+    exported_ids = {row["id"] for row in rows if row["type"] == "message"}
+    assert late_id not in exported_ids
+    assert all(row["message_id"] in exported_ids for row in rows if row["type"] == "like")
+
+
+def test_main_shard_reuses_request_session():
+    db = db_handler.SessionLocal()
+    try:
+        dependency = main.get_shard_db(1, request=None, db=db)
+        assert next(dependency) is db
+    finally:
+        db.close()
+
+
+def test_archived_messages_are_paged_after_hot_ones(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "MESSAGE_ARCHIVE_DIR", str(tmp_path))
+    records = [{"id": message_id, "group_id": 99, "user_id": 1, "message": f"old {message_id}",
+                "created_at": "2020-01-01T00:00:00", "likes": []} for message_id in range(1, 601)]
+    assert archive_handler.write_segment(99, iter(records)) == 600
+    assert archive_handler.last_archived_id(99) == 600
+    page = archive_handler.read_messages(99, before_id=300, limit=3)
+    assert [message.id for message in page] == [299, 298, 297]
+    assert [record["id"] for record in archive_handler.iter_records(99)] == list(range(1, 601))
+
+
+def test_route_classes():
+    assert admission_handler.get_route_class("POST", "/token/") == "auth"
+    assert admission_handler.get_route_class("PUT", "/users/2") == "admin"
+    assert admission_handler.get_route_class("GET", "/groups/search") == "search"
+    assert admission_handler.get_route_class("POST", "/groups/1/messages/") == "messages"
+    assert admission_handler.get_route_class("GET", "/groups/1/export") == "reads"
+    assert admission_handler.get_route_class("DELETE", "/groups/1") == "writes"
+    assert admission_handler.get_route_class("GET", "/docs") is None
+
+
+def test_requests_over_the_limit_are_shed(monkeypatch):
+    header = user_authentication_headers("admin", "admin")
+    monkeypatch.setitem(config.ADMISSION_LIMITS, "search", {**config.ADMISSION_LIMITS["search"], "max_in_flight": 0})
+    response = client.get("/groups/search?name=testgroup", headers=header)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(config.ADMISSION_RETRY_AFTER_SECONDS)
+    response = client.get("/admission/metrics", headers=header)
+    assert response.status_code == 200
+    assert response.json()["routes"]["search"]["shed_in_flight"] >= 1
+    assert response.json()["routes"]["search"]["in_flight"] == 0
+
+
+def create_baseline_shard(tmp_path):
+    # messages tables as created before the archive, without created_at and AUTOINCREMENT
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path}/baseline.db")
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE messages (id INTEGER NOT NULL, group_id INTEGER, user_id INTEGER, "
+                             "message VARCHAR(250), PRIMARY KEY (id))")
+        conn.exec_driver_sql("CREATE INDEX ix_messages_id ON messages (id)")
+        conn.exec_driver_sql("CREATE TABLE message_likes (id INTEGER NOT NULL, message_id INTEGER, user_id INTEGER, "
+                             "PRIMARY KEY (id), FOREIGN KEY(message_id) REFERENCES messages (id))")
+        for message_id in range(1, 4):
+            conn.exec_driver_sql(f"INSERT INTO messages VALUES ({message_id}, 1, 2, 'old {message_id}')")
+        conn.exec_driver_sql("INSERT INTO message_likes VALUES (1, 3, 2)")
+    return engine
+
+
+def count_rows(engine, table):
+    with engine.connect() as conn:
+        return conn.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(table)).scalar()
+
+
+def test_migrate_baseline_messages_table(tmp_path):
+    engine = create_baseline_shard(tmp_path)
+    assert migrate_messages.ids_can_be_reused(engine)
+    assert migrate_messages.add_created_at(engine)
+    assert not migrate_messages.add_created_at(engine)
+    assert "ix_messages_group_id_id" in migrate_messages.add_missing_indexes(engine)
+    assert migrate_messages.add_missing_indexes(engine) == []
+    assert migrate_messages.rebuild_with_autoincrement(engine)
+    assert not migrate_messages.ids_can_be_reused(engine)
+    assert count_rows(engine, model.Message.__table__) == 3
+    assert {index["name"] for index in sqlalchemy.inspect(engine).get_indexes("messages")} == \
+        {index.name for index in model.Message.__table__.indexes}
+    with engine.begin() as conn:
+        conn.execute(sqlalchemy.delete(model.Message.__table__))
+        conn.execute(model.Message.__table__.insert().values(group_id=1, user_id=2, message="new"))
+        assert conn.execute(sqlalchemy.select(model.Message.__table__.c.id)).scalar() == 4
+
+
+def test_archive_group_deletes_only_archived_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "MESSAGE_ARCHIVE_DIR", str(tmp_path / "archive"))
+    engine = create_baseline_shard(tmp_path)
+    migrate_messages.add_created_at(engine)
+    migrate_messages.rebuild_with_autoincrement(engine)
+    messages = model.Message.__table__
+    likes = model.MessageLike.__table__
+    future = datetime.utcnow() + timedelta(days=1)
+
+    # a like posted between writing the segment and deleting its rows stops the delete
+    write_segment = archive_handler.write_segment
+
+    def write_segment_then_like(group_id, records):
+        written = write_segment(group_id, records)
+        with engine.begin() as conn:
+            conn.execute(likes.insert().values(message_id=1, user_id=5))
+        return written
+
+    monkeypatch.setattr(archive_handler, "write_segment", write_segment_then_like)
+    assert archive_messages.archive_group(engine, 1, future) == 0
+    assert archive_handler.segment_paths(1) == []
+    assert count_rows(engine, messages) == 3
+    assert count_rows(engine, likes) == 2
+
+    monkeypatch.setattr(archive_handler, "write_segment", write_segment)
+    assert archive_messages.archive_group(engine, 1, future) == 3
+    assert count_rows(engine, messages) == 0
+    assert count_rows(engine, likes) == 0
+    assert [len(record["likes"]) for record in archive_handler.iter_records(1)] == [1, 0, 1]
+
+    # a message posted after archiving is neither reused nor deleted by the next run
+    with engine.begin() as conn:
+        conn.execute(messages.insert().values(group_id=1, user_id=2, message="new", created_at=future))
+    assert archive_messages.archive_group(engine, 1, datetime.utcnow()) == 0
+    assert [message.id for message in archive_handler.read_messages(1)] == [3, 2, 1]
+    with engine.connect() as conn:
+        assert conn.execute(sqlalchemy.select(messages.c.id)).scalars().all() == [4]
+
+
+def test_export_snapshots_the_archive(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "MESSAGE_ARCHIVE_DIR", str(tmp_path / "archive"))
+    engine = create_baseline_shard(tmp_path)
+    migrate_messages.add_created_at(engine)
+    migrate_messages.rebuild_with_autoincrement(engine)
+    future = datetime.utcnow() + timedelta(days=1)
+
+    def export():
+        db = sessionmaker(bind=engine)()
+        try:
+            return [json.loads(line) for line in "".join(crud.export_group_history(db, 1)).splitlines()]
+        finally:
+            db.close()
+
+    # a segment written but not finished yet holds the same messages as the hot rows
+    write_segment = archive_handler.write_segment
+    exports = []
+
+    def write_segment_then_export(group_id, records):
+        written = write_segment(group_id, records)
+        exports.append(export())
+        return written
+
+    monkeypatch.setattr(archive_handler, "write_segment", write_segment_then_export)
+    assert archive_messages.archive_group(engine, 1, future) == 3
+    assert [row["id"] for row in exports[0] if row["type"] == "message"] == [1, 2, 3]
+    assert exports[0][-1] == {"type": "end", "messages": 3, "likes": 1}
+    monkeypatch.setattr(archive_handler, "write_segment", write_segment)
+
+    # an archive run during the export moves rows it has not read yet
+    with engine.begin() as conn:
+        conn.execute(model.Message.__table__.insert().values(group_id=1, user_id=2, message="new"))
+    db = sessionmaker(bind=engine)()
+    try:
+        chunks = crud.export_group_history(db, 1)
+        next(chunks)
+        assert archive_messages.archive_group(engine, 1, future) == 1
+        with pytest.raises(RuntimeError):
+            list(chunks)
+    finally:
+        db.close()
+    assert [row["id"] for row in export() if row["type"] == "message"] == [1, 2, 3, 4]
+
+
+def test_rewritten_segment_is_not_read_with_a_stale_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "MESSAGE_ARCHIVE_DIR", str(tmp_path))
+    records = [{"id": message_id, "group_id": 98, "user_id": 1, "message": f"old {message_id}",
+                "created_at": None, "likes": []} for message_id in range(1, 4)]
+    archive_handler.write_segment(98, iter(records))
+    [removed] = archive_handler.segment_paths(98)
+    archive_handler.read_index(removed)
+    # removed by another process, whose cache is not cleared here
+    archive_handler.os.remove(removed)
+    records[0]["message"] = "changed " * 50
+    archive_handler.write_segment(98, iter(records))
+    assert archive_handler.segment_paths(98) != [removed]
+    assert [message.message for message in archive_handler.read_messages(98)][-1] == records[0]["message"]
+
+
+def test_archive_refuses_ids_that_can_be_reused(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive_messages, "shard_engines", [create_baseline_shard(tmp_path)])
+    with pytest.raises(RuntimeError):
+        archive_messages.archive_messages()
+
+
+def test_pool_timeout_is_recorded_and_shed(tmp_path):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path}/pool.db", pool_size=1, max_overflow=0, pool_timeout=0.3)
+    request = SimpleNamespace(state=SimpleNamespace(route_class="search"))
+    timeouts = admission_handler.metrics["search"]["pool_timeouts"]
+    with engine.connect():
+        db = sessionmaker(bind=engine)()
+        with pytest.raises(HTTPException) as error:
+            main.connect(db, request)
+        db.close()
+    assert error.value.status_code == 503
+    assert admission_handler.metrics["search"]["pool_timeouts"] == timeouts + 1
+    assert admission_handler.metrics["search"]["pool_wait_max"] >= 0.3
+    assert admission_handler.recent_pool_wait() > 0
+
+
+def test_admission_limits_fit_the_pool(monkeypatch):
+    assert all(limits["max_in_flight"] <= limits["max_total_in_flight"] <= config.DB_POOL_CAPACITY
+               for limits in config.ADMISSION_LIMITS.values())
+    # the other classes admitted up to their common limit still leave the reserved connections to messages
+    free = config.ADMISSION_MAX_IN_FLIGHT
+    for route_class, limits in config.ADMISSION_LIMITS.items():
+        if route_class != "messages":
+            monkeypatch.setitem(admission_handler.metrics[route_class], "in_flight", min(limits["max_in_flight"], free))
+            free -= admission_handler.metrics[route_class]["in_flight"]
+    assert admission_handler.admit("reads") == "shed_in_flight"
+    assert admission_handler.admit("search") == "shed_in_flight"
+    for _ in range(config.ADMISSION_MESSAGES_RESERVE):
+        assert admission_handler.admit("messages") is None
+    assert admission_handler.admit("messages") == "shed_in_flight"
+    monkeypatch.setitem(admission_handler.metrics["messages"], "in_flight", 0)